@@ -21,61 +21,137 @@ along with GitWeb Project.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import os
 import sys
-import socket
+import time
 import logging
+import threading
 import subprocess
 import subprocessio
-from webob import Request, Response, exc
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from webob import Request, exc
 
 logger = logging.getLogger(__name__)
 log = print
 
-class FileWrapper(object):
-    def __init__(self, fd, content_length):
-        self.fd = fd
-        self.content_length = content_length
-        self.remain = content_length
+def respond(start_response, status, headers, app_iter):
+    start_response(status, headers)
+    return app_iter
+
+
+def etag_matches(environ, etag):
+    """True if the request's If-None-Match lists etag."""
+    header = environ.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = set(t.strip() for t in header.split(','))
+    return '*' in tags or '"%s"' % etag in tags or 'W/"%s"' % etag in tags
+
+
+def valid_repo_name(repo_name):
+    """
+    True if repo_name, one path segment, can only be an entry of the served
+    directory, which makes a realpath() check unnecessary. Backslashes and
+    colons are separators or drives on Windows (joining 'D:evil.git' would
+    drop the directory altogether), and NUL cannot be in a path at all.
+    """
+    return not (repo_name.startswith('.') or '\\' in repo_name or ':' in repo_name
+                or '\x00' in repo_name)
+
+
+def run_after(iterable, callback):
+    """Yield from iterable, then call callback once it is exhausted or closed."""
+    try:
+        for chunk in iterable:
+            yield chunk
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+        callback()
+
+
+class AdvertCache(object):
+    """
+    Bounded LRU of ref advertisements, keyed on (content_path, git_command).
+    An entry is only served while the mtimes it was stored with are current.
+    """
+    # refs changed more recently than this may still change within the same
+    # mtime granularity (racy-git), such advertisements are not cached.
+    racy_delay = 2
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, advert):
+        with self.lock:
+            self.data[key] = (version, advert)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def cacheable(self, version):
+        return time.time() - max(version) / 1e9 > self.racy_delay
+
+    def tee(self, key, version, iterable):
+        """Yield from iterable and store what it yielded once fully consumed."""
+        chunks = []
+        try:
+            for chunk in iterable:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+        self.put(key, version, b''.join(chunks))
 
-    def read(self, size):
-        if size <= self.remain:
-            try:
-                data = self.fd.read(size)
-            except socket.error:
-                raise IOError(self)
-            self.remain -= size
-        elif self.remain:
-            data = self.fd.read(self.remain)
-            self.remain = 0
-        else:
-            data = None
-        return data
 
-    def __repr__(self):
-        return '<FileWrapper %s len: %s, read: %s>' % (self.fd, self.content_length, self.content_length - self.keep)
+advert_cache = AdvertCache()
 
 
 class GitRepository(object):
     git_folder_signature = set(['config', 'head', 'info', 'objects', 'refs'])
     commands = ['git-upload-pack', 'git-receive-pack']
+    # size of the reads done on git's stdout. Pack data is large, so bigger
+    # reads mean fewer syscalls and loop iterations per byte served.
+    chunk_size = 1 << 20
 
-    def __init__(self, content_path):
+    def __init__(self, content_path, chunk_size=None):
         # 确认 content_path 下有 git_folder_signature 中的所有文件
         # 意思就是判断 content_path 是不是一个 Git 文件夹
         # 是就初始化
 
-        files = set([f.lower() for f in os.listdir(content_path)])
-        assert self.git_folder_signature.intersection(files) == self.git_folder_signature, content_path
+        found = set()
+        with os.scandir(content_path) as entries:
+            for entry in entries:
+                name = entry.name.lower()
+                if name in self.git_folder_signature:
+                    found.add(name)
+                    if len(found) == len(self.git_folder_signature):
+                        break
+        assert found == self.git_folder_signature, content_path
         self.content_path = content_path
-        self.valid_accepts = ['application/x-%s-result' % c for c in self.commands]
-
-    def inforefs(self, request, environ):
-        """WSGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
-        # 主要逻辑就是处理 get 请求， 返回响应
-
-        # 获取 Git 命令 并判断 命令是否有效
-        git_command = request.GET['service']
-        if git_command not in self.commands:
-            return exc.HTTPMethodNotAllowed()
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.valid_accepts = frozenset('application/x-%s-result' % c for c in self.commands)
+        # the command lines only depend on the repository path, build them once
+        self._advert_cmd = dict(
+            (c, ['git', c[4:], '--stateless-rpc', '--advertise-refs', content_path])
+            for c in self.commands)
+        self._rpc_cmd = dict(
+            (c, ['git', c[4:], '--stateless-rpc', content_path])
+            for c in self.commands)
+        self._update_server_info_cmd = ['git', '--git-dir', content_path, 'update-server-info']
 
         # note to self:
         # please, resist the urge to add '\n' to git capture and increment line count by 1.
@@ -83,43 +159,109 @@ class GitRepository(object):
         # if you sprinkle "flush" (0000) as "0001\n".
         # It reads binary, per number of bytes specified.
         # if you do add '\n' as part of data, count it.
-        smart_server_advert = '# service=%s' % git_command
+        self._advert_pkt = {}
+        for c in self.commands:
+            smart_server_advert = b'# service=git-%s' % c[4:].encode('ascii')
+            self._advert_pkt[c] = b'%04x%s0000' % (len(smart_server_advert) + 4, smart_server_advert)
+
+    def inforefs(self, environ, start_response):
+        """WSGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
+        # 主要逻辑就是处理 get 请求， 返回响应
+
+        # 获取 Git 命令 并判断 命令是否有效
+        git_command = parse_qs(environ.get('QUERY_STRING', '')).get('service', [''])[0]
+        if git_command not in self.commands:
+            return exc.HTTPMethodNotAllowed()(environ, start_response)
+
+        headers = [('Content-Type', 'application/x-%s-advertisement' % git_command)]
+
+        # upload-pack's advertisement only changes with the repository files below, serve it
+        # from cache when we can. receive-pack's may carry a time based push-cert nonce.
+        key = (self.content_path, git_command)
+        etag = None
+        if git_command == u'git-upload-pack':
+            version = self.advert_mtimes()
+            if advert_cache.cacheable(version):
+                etag = '-'.join('%x' % mtime for mtime in version)
+                if etag_matches(environ, etag):
+                    return exc.HTTPNotModified(etag=etag)(environ, start_response)
+                headers.append(('ETag', '"%s"' % etag))
+                advert = advert_cache.get(key, version)
+                if advert is not None:
+                    return respond(start_response, '200 OK', headers, [advert])
+
         try:
             # 分到子进程处理执行 git 命令
             out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc --advertise-refs "%s"' % (git_command[4:], self.content_path),
-                starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
+                self._advert_cmd[git_command],
+                buffer_size = self.chunk_size,
+                chunk_size = self.chunk_size,
+                pipe_size = self.chunk_size,
+                starting_values = [self._advert_pkt[git_command]]
             )
         except EnvironmentError as e:
             logger.exception(e)
             raise exc.HTTPExpectationFailed()
+        if etag is not None:
+            out = advert_cache.tee(key, version, out)
         # 返回响应
-        resp = Response()
-        resp.content_type = 'application/x-%s-advertisement' % str(git_command)
-        resp.app_iter = out
-        return resp
+        return respond(start_response, '200 OK', headers, out)
 
-    def backend(self, request, environ):
+    def advert_mtimes(self):
+        """
+        Mtimes (ns) of everything the upload-pack advertisement is built from:
+        config (hidden refs, capabilities), objects/info/alternates, shallow
+        (grafts), HEAD, packed-refs and the latest of the directories refs are
+        stored in.
+        Updating a loose ref renames a file into its directory, so watching the
+        directories is enough to notice it. Missing files count as 0.
+        """
+        mtimes = []
+        for name in ('config', os.path.join('objects', 'info', 'alternates'), 'shallow',
+                     'HEAD', 'packed-refs'):
+            try:
+                mtimes.append(os.stat(os.path.join(self.content_path, name)).st_mtime_ns)
+            except OSError:
+                mtimes.append(0)
+        latest = 0
+        for name in ('refs', 'reftable'):
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.content_path, name)):
+                try:
+                    latest = max(latest, os.stat(dirpath).st_mtime_ns)
+                except OSError:
+                    pass
+        mtimes.append(latest)
+        return tuple(mtimes)
+
+    def backend(self, environ, start_response):
         """
         WSGI Response producer for HTTP POST Git Smart HTTP requests.
         Reads commands and data from HTTP POST's body.
         returns an iterator obj with contents of git command's response to stdout
         """
         # 处理 post 请求
-        git_command = request.path_info.strip('/')
+        git_command = environ.get('PATH_INFO', '').strip('/')
         if git_command not in self.commands:
-            return exc.HTTPMethodNotAllowed()
+            return exc.HTTPMethodNotAllowed()(environ, start_response)
 
         # 读取请求信息
-        if 'CONTENT_LENGTH' in environ:
-            inputstream = FileWrapper(environ['wsgi.input'], request.content_length)
+        # CONTENT_LENGTH is authoritative when given, chunked requests are read to EOF
+        content_length = environ.get('CONTENT_LENGTH')
+        if content_length and content_length.isdigit():
+            input_length = int(content_length)
         else:
-            inputstream = environ['wsgi.input']
+            input_length = None
 
+        # the output is not handed to wsgi.file_wrapper: git's stdout is a pipe, which
+        # cannot be a sendfile source, and iterating it is what notices git failing.
         try:
             out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc "%s"' % (git_command[4:], self.content_path),
-                inputstream = inputstream
+                self._rpc_cmd[git_command],
+                inputstream = environ['wsgi.input'],
+                input_length = input_length,
+                buffer_size = self.chunk_size,
+                chunk_size = self.chunk_size,
+                pipe_size = self.chunk_size
             )
         except EnvironmentError as e:
             logger.exception(e)
@@ -127,47 +269,56 @@ class GitRepository(object):
 
         if git_command in [u'git-receive-pack']:
             # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
-            subprocess.call(u'git --git-dir "%s" update-server-info' % self.content_path, shell=True)
+            # refs are only updated once receive-pack is done, so run it when the
+            # response has been sent instead of blocking the request on it.
+            out = run_after(out, self.update_server_info)
+
+        return respond(start_response, '200 OK',
+                       [('Content-Type', 'application/x-%s-result' % git_command)], out)
 
-        resp = Response()
-        resp.content_type = 'application/x-%s-result' % git_command.encode('utf8')
-        resp.app_iter = out
-        return resp
+    def update_server_info(self):
+        proc = subprocess.Popen(self._update_server_info_cmd, close_fds=True)
+        # reaped in the background, nothing waits for its result
+        threading.Thread(target=proc.wait, daemon=True).start()
 
     def __call__(self, environ, start_response):
         logger.info("GitRepository call")
-        request = Request(environ)
-        if request.path_info.startswith('/info/refs'):
+        # only a few CGI variables are needed, read them without building a webob Request
+        accept = environ.get('HTTP_ACCEPT', '')
+        if environ.get('PATH_INFO', '').startswith('/info/refs'):
             app = self.inforefs
-        elif [a for a in self.valid_accepts if a in request.accept]:
+        elif any(a in accept for a in self.valid_accepts):
             # 如果前端请求的 request.accept 中有 valid_accepts 中的内容
             app = self.backend
+        else:
+            return exc.HTTPNotFound()(environ, start_response)
 
         try:
-            resp = app(request, environ)
+            return app(environ, start_response)
         except exc.HTTPException as e:
-            resp = e
             logger.exception(e)
+            return e(environ, start_response)
         except Exception as e:
             logger.exception(e)
-            resp = exc.HTTPInternalServerError()
-
-        start_response(resp.status, resp.headers.items())
-        return resp.app_iter
+            return exc.HTTPInternalServerError()(environ, start_response)
 
 
 class GitDirectory(object):
 
     repository_app = GitRepository
 
-    def __init__(self, content_path, auto_create=True, **kwargs):
+    def __init__(self, content_path, auto_create=True, chunk_size=None, **kwargs):
         if not os.path.isdir(content_path):
             if auto_create:
                 os.makedirs(content_path)
             else:
                 raise OSError(content_path)
-        self.content_path = content_path
+        # resolved once, repository paths are built under it without touching the filesystem
+        self.content_path = os.path.realpath(content_path)
         self.auto_create = auto_create
+        self.chunk_size = chunk_size
+        self._apps = {}
+        self._lock = threading.Lock()
         if 'pre_clone_hook' in kwargs:
             self.pre_clone_hook = kwargs['pre_clone_hook']
         if 'post_clone_hook' in kwargs:
@@ -186,40 +337,56 @@ class GitDirectory(object):
         repo_name = request.path_info_pop()
         if not repo_name.endswith('.git'):
             return exc.HTTPNotFound()(environ, start_response)
-        content_path = os.path.realpath(os.path.join(self.content_path, repo_name))
-        if self.content_path not in content_path:
+        if not valid_repo_name(repo_name):
             return exc.HTTPForbidden()(environ, start_response)
-        try:
-            app = GitRepository(content_path)
-        except (AssertionError, OSError):
-            if os.path.isdir(content_path):
-                app = self.repository_app(content_path)
-            else:
-                if self.auto_create and 'application/x-git-receive-pack-result' in request.accept:
-                    try:
-                        self.pre_clone_hook(content_path, request)
-                        subprocess.call(u'git init --quiet --bare "%s"' % content_path, shell=True)
-                        self.post_clone_hook(content_path, request)
-                    except exc.HTTPException as e:
-                        return e(environ, start_response)
-                    app = self.repository_app(content_path)
+        content_path = os.path.join(self.content_path, repo_name)
+        # the repository layout is only checked the first time it is served
+        app = self._apps.get(content_path)
+        if app is not None and not os.path.isdir(content_path):
+            # removed since, forget it so that it can be created again
+            with self._lock:
+                self._apps.pop(content_path, None)
+            app = None
+        if app is None:
+            # subclasses' repository_app may predate chunk_size, only pass it when set
+            options = {'chunk_size': self.chunk_size} if self.chunk_size else {}
+            try:
+                app = GitRepository(content_path, **options)
+            except (AssertionError, OSError):
+                if os.path.isdir(content_path):
+                    app = self.repository_app(content_path, **options)
                 else:
-                    return exc.HTTPNotFound()(environ, start_response)
+                    if self.auto_create and 'application/x-git-receive-pack-result' in request.accept:
+                        try:
+                            self.pre_clone_hook(content_path, request)
+                            subprocess.call(['git', 'init', '--quiet', '--bare', content_path])
+                            self.post_clone_hook(content_path, request)
+                        except exc.HTTPException as e:
+                            return e(environ, start_response)
+                        app = self.repository_app(content_path, **options)
+                    else:
+                        return exc.HTTPNotFound()(environ, start_response)
+            with self._lock:
+                app = self._apps.setdefault(content_path, app)
         return app(environ, start_response)
 
 
-def make_app(global_config, content_path='', **local_config):
+def make_app(global_config, content_path='', chunk_size=None, **local_config):
     logger.info("make_app")
     if 'content_path' in global_config:
         content_path = global_config['content_path']
-    return GitRepository(content_path)
+    if chunk_size:
+        chunk_size = int(chunk_size)
+    return GitRepository(content_path, chunk_size)
 
 
-def make_dir_app(global_config, content_path='', auto_create=None, **local_config):
+def make_dir_app(global_config, content_path='', auto_create=None, chunk_size=None, **local_config):
     logger.info("make_dir_app")
     if 'content_path' in global_config:
         content_path = global_config['content_path']
-    return GitDirectory(content_path, auto_create=auto_create)
+    if chunk_size:
+        chunk_size = int(chunk_size)
+    return GitDirectory(content_path, auto_create=auto_create, chunk_size=chunk_size)
 
 
 # if __name__ == "__main__":
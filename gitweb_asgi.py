@@ -0,0 +1,254 @@
+'''
+Module provides ASGI applications serving git-http-backend's Smart HTTP
+protocol on top of asyncio.
+
+The WSGI applications in gitweb pin a worker thread for the whole life of a
+git subprocess. Here git is driven with asyncio subprocesses instead, so a
+single event loop can stream many clones and pushes concurrently.
+
+This file is part of GitWeb Project.
+
+GitWeb Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+GitWeb Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with GitWeb Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from gitweb import GitRepository, valid_repo_name
+
+logger = logging.getLogger(__name__)
+
+
+async def respond(send, status, body=b'', content_type='text/plain'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', b'%d' % len(body))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+class AsyncGitRepository(object):
+    """ASGI counterpart of gitweb.GitRepository."""
+
+    def __init__(self, content_path, chunk_size=None):
+        # validates content_path and builds the command lines
+        self.repository = GitRepository(content_path, chunk_size)
+        self.content_path = content_path
+        self.chunk_size = self.repository.chunk_size
+
+    async def start(self, cmd, stdin=None):
+        return await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=self.chunk_size)
+
+    async def stream(self, proc, send, content_type, starting_values=()):
+        """Send git's stdout as the response body.
+
+        Nothing is sent until git produced its first chunk, so a git failure
+        can still be reported with a proper status. Past that point a failure
+        raises before the body is terminated.
+        """
+        errors = asyncio.ensure_future(proc.stderr.read())
+        chunk = await proc.stdout.read(self.chunk_size)
+        if not chunk:
+            returncode = await proc.wait()
+            if returncode:
+                logger.error('%s exited with %s: %s', self.content_path,
+                             returncode, (await errors).decode('utf8', 'replace'))
+                await respond(send, 417, b'Expectation Failed')
+                return
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', content_type.encode('latin-1'))],
+        })
+        for value in starting_values:
+            await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+        while chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await proc.stdout.read(self.chunk_size)
+        returncode = await proc.wait()
+        if returncode:
+            # git died half way through, do not let the output pass as complete
+            message = (await errors).decode('utf8', 'replace')
+            logger.error('%s exited with %s: %s', self.content_path, returncode, message)
+            raise EnvironmentError('Subprocess exited due to an error:\n' + message)
+        await send({'type': 'http.response.body', 'body': b''})
+        await errors
+
+    async def inforefs(self, scope, receive, send):
+        """ASGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        git_command = query.get('service', [''])[0]
+        if git_command not in self.repository.commands:
+            return await respond(send, 405, b'Method Not Allowed')
+
+        try:
+            proc = await self.start(self.repository._advert_cmd[git_command])
+        except EnvironmentError as e:
+            logger.exception(e)
+            return await respond(send, 417, b'Expectation Failed')
+        try:
+            await self.stream(proc, send, 'application/x-%s-advertisement' % git_command,
+                              [self.repository._advert_pkt[git_command]])
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    async def feed(self, proc, receive):
+        """Copy the request body into git's stdin as it arrives."""
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    proc.kill()
+                    return
+                proc.stdin.write(message.get('body', b''))
+                await proc.stdin.drain()
+                more_body = message.get('more_body', False)
+        except (BrokenPipeError, ConnectionResetError):
+            # git stopped reading, its exit status tells what happened
+            pass
+        finally:
+            proc.stdin.close()
+
+    async def backend(self, scope, receive, send):
+        """
+        ASGI Response producer for HTTP POST Git Smart HTTP requests.
+        Streams the HTTP POST's body to the git command and its stdout back.
+        """
+        git_command = scope['path'].strip('/')
+        if git_command not in self.repository.commands:
+            return await respond(send, 405, b'Method Not Allowed')
+
+        try:
+            proc = await self.start(self.repository._rpc_cmd[git_command],
+                                    stdin=asyncio.subprocess.PIPE)
+        except EnvironmentError as e:
+            logger.exception(e)
+            return await respond(send, 417, b'Expectation Failed')
+
+        feeder = asyncio.ensure_future(self.feed(proc, receive))
+        try:
+            await self.stream(proc, send, 'application/x-%s-result' % git_command)
+        finally:
+            feeder.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if git_command == 'git-receive-pack':
+                # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
+                # refs may have been updated before a failure too, so this runs either way.
+                await self.update_server_info()
+
+    async def update_server_info(self):
+        proc = await asyncio.create_subprocess_exec(*self.repository._update_server_info_cmd)
+        await proc.wait()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        accept = b', '.join(v for k, v in scope['headers'] if k == b'accept').decode('latin-1')
+        if scope['path'].startswith('/info/refs'):
+            app = self.inforefs
+        elif any(a in accept for a in self.repository.valid_accepts):
+            app = self.backend
+        else:
+            return await respond(send, 404, b'Not Found')
+
+        started = False
+
+        async def tracked_send(message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await app(scope, receive, tracked_send)
+        except Exception as e:
+            if started:
+                # too late for an error page, let the server drop the connection
+                raise
+            logger.exception(e)
+            await respond(send, 500, b'Internal Server Error')
+
+
+class AsyncGitDirectory(object):
+    """
+    ASGI counterpart of gitweb.GitDirectory. Serves the repositories found in
+    content_path; repositories are not created on push.
+    """
+
+    repository_app = AsyncGitRepository
+
+    def __init__(self, content_path, chunk_size=None):
+        if not os.path.isdir(content_path):
+            raise OSError(content_path)
+        self.content_path = os.path.realpath(content_path)
+        self.chunk_size = chunk_size
+        self._apps = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        repo_name, _, path = scope['path'].lstrip('/').partition('/')
+        if not repo_name.endswith('.git'):
+            return await respond(send, 404, b'Not Found')
+        if not valid_repo_name(repo_name):
+            return await respond(send, 403, b'Forbidden')
+
+        content_path = os.path.join(self.content_path, repo_name)
+        app = self._apps.get(content_path)
+        if app is not None and not os.path.isdir(content_path):
+            # removed since, forget it
+            del self._apps[content_path]
+            app = None
+        if app is None:
+            # like GitDirectory, only pass chunk_size to repository_app when set
+            options = {'chunk_size': self.chunk_size} if self.chunk_size else {}
+            try:
+                app = self.repository_app(content_path, **options)
+            except (AssertionError, OSError):
+                return await respond(send, 404, b'Not Found')
+            self._apps[content_path] = app
+
+        scope = dict(scope,
+                     root_path=scope.get('root_path', '') + '/' + repo_name,
+                     path='/' + path)
+        await app(scope, receive, send)
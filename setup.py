@@ -16,7 +16,7 @@ setup(name='GitWeb',
       url='https://github.com/gawel/GitWeb',
       licence='GPL',
       keywords='web',
-      py_modules = ['gitweb', 'subprocessio'],
+      py_modules = ['gitweb', 'gitweb_asgi', 'subprocessio'],
       packages=find_packages(exclude=['tests']),
       include_package_data=True,
       zip_safe=False,
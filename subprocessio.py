@@ -26,8 +26,47 @@ along with git_http_backend.py Project.  If not, see <http://www.gnu.org/license
 from collections import deque
 import threading
 import subprocess
+import sys
 import os
 
+try:
+    import fcntl
+except ImportError: # not on posix
+    fcntl = None
+
+# Linux only, and not exposed by the fcntl module before python 3.10
+if fcntl is not None and sys.platform.startswith('linux'):
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+else:
+    F_SETPIPE_SZ = None
+
+
+def copy_limited(src, fd, n = None, buf = None):
+    '''
+    Copies up to n bytes (all of it when n is None) from file-like src into
+    file descriptor fd. Reads go through one reused buffer, with readinto()
+    when src has it.
+    '''
+    if buf is None:
+        buf = bytearray(65536 if n is None else max(1, min(n, 1 << 20)))
+    view = memoryview(buf)
+    readinto = getattr(src, 'readinto', None)
+    while n is None or n > 0:
+        size = len(buf) if n is None else min(n, len(buf))
+        if readinto is not None:
+            got = readinto(view[:size])
+            data = view[:got or 0]
+        else:
+            data = memoryview(src.read(size))
+            got = len(data)
+        if not got:
+            break
+        while data:
+            # os.write may take only part of it
+            data = data[os.write(fd, data):]
+        if n is not None:
+            n -= got
+
 
 class StreamFeeder(threading.Thread):
     """
@@ -36,7 +75,7 @@ class StreamFeeder(threading.Thread):
     without blocking the main thread.
     We close inpipe once the end of the source stream is reached.
     """
-    def __init__(self, source):
+    def __init__(self, source, length = None):
         super(StreamFeeder,self).__init__()
         self.daemon = True
         filelike = False
@@ -44,7 +83,7 @@ class StreamFeeder(threading.Thread):
         if type(source) in (type(''),bytes,bytearray): # string-like
             self.bytes = bytes(source)
         else: # can be either file pointer or file-like
-            if type(source) in (int, long): # file pointer it is
+            if isinstance(source, int): # file pointer it is
                 ## converting file descriptor (int) stdin into file-like
                 try:
                     source = os.fdopen(source, 'rb', 16384)
@@ -58,18 +97,17 @@ class StreamFeeder(threading.Thread):
         if not filelike and not self.bytes:
             raise TypeError("StreamFeeder's source object must be a readable file-like, a file descriptor, or a string-like.")
         self.source = source
+        self.length = length
         self.readiface, self.writeiface = os.pipe()
 
     def run(self):
         t = self.writeiface
         if self.bytes:
-            os.write(t, self.bytes)
+            data = memoryview(self.bytes)
+            while data:
+                data = data[os.write(t, data):]
         else:
-            s = self.source
-            b = s.read(4096)
-            while b:
-                os.write(t, b)
-                b = s.read(4096)
+            copy_limited(self.source, t, self.length)
         os.close(t)
 
     @property
@@ -119,7 +157,10 @@ class InputStreamChunker(threading.Thread):
         kr = self.keep_reading
         da = self.data_added
         go = self.go
-        b = s.read(cs)
+        # read1 hands out what the pipe has (up to cs) instead of waiting for cs bytes,
+        # so progress and keepalive packets are not held back by a large chunk_size
+        read = getattr(s, 'read1', s.read)
+        b = read(cs)
         while b and go.is_set():
             if len(t) > ccm:
                 kr.clear()
@@ -132,7 +173,7 @@ class InputStreamChunker(threading.Thread):
                     raise IOError("Timed out while waiting for input from subprocess.")
             t.append(b)
             da.set()
-            b = s.read(cs)
+            b = read(cs)
         self.EOF.set()
         da.set() # for cases when done but there was no input.
 
@@ -179,7 +220,6 @@ class BufferedGenerator():
             self.worker.keep_reading.set()
 
             d = self.data.popleft()
-            print("buffer next data:", d, type(d))
             if isinstance(d, str):
                 return bytes(d.encode())
             elif isinstance(d, bytes):
@@ -188,6 +228,8 @@ class BufferedGenerator():
         elif self.worker.EOF.is_set():
             raise StopIteration
 
+    __next__ = next
+
     def throw(self, type, value=None, traceback=None):
         if not self.worker.EOF.is_set():
             raise type(value)
@@ -323,35 +365,49 @@ class SubprocessIOChunker():
 
 
     '''
-    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = []):
+    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = [], pipe_size = None, input_length = None):
         '''
         Initializes SubprocessIOChunker
 
-        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings
+        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings.
+            A string is run through the shell, an array is executed directly.
         @param inputstream (Default: None) A file-like, string, or file pointer.
+        @param input_length (Default: None) How many bytes to read from a file-like
+            inputstream, read until EOF when None.
         @param buffer_size (Default: 65536) A size of total buffer per stream in bytes.
         @param chunk_size (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
         @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param pipe_size (Default: None) If set, the size in bytes the kernel buffer of
+            the subprocess's stdout pipe is grown to, where the platform allows it.
         '''
 
         if inputstream:
-            input_streamer = StreamFeeder(inputstream)
+            input_streamer = StreamFeeder(inputstream, input_length)
             input_streamer.start()
             inputstream = input_streamer.output
 
         _p = subprocess.Popen(cmd,
             bufsize = -1,
-            shell = True,
+            shell = isinstance(cmd, str),
             stdin = inputstream,
             stdout = subprocess.PIPE,
             stderr = subprocess.PIPE
             )
 
+        if pipe_size and F_SETPIPE_SZ is not None:
+            try:
+                fcntl.fcntl(_p.stdout.fileno(), F_SETPIPE_SZ, pipe_size)
+            except (IOError, OSError):
+                # above /proc/sys/fs/pipe-max-size. Keep the default.
+                pass
+
         bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values)
         bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless = True)
 
-        while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
-            # doing this until we reach either end of file, or end of buffer.
+        while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length \
+                and bg_out.length <= len(starting_values):
+            # doing this until we reach either end of file, end of buffer or
+            # the first output of the subprocess.
             bg_out.data_added_event.wait(1)
             bg_out.data_added_event.clear()
 
@@ -367,7 +423,7 @@ class SubprocessIOChunker():
                 pass
             bg_out.stop()
             bg_err.stop()
-            raise EnvironmentError("Subprocess exited due to an error.\n" + "".join(bg_err))
+            raise EnvironmentError("Subprocess exited due to an error.\n" + b"".join(bg_err).decode('utf8', 'replace'))
 
         self.process = _p
         self.output = bg_out
@@ -378,9 +434,20 @@ class SubprocessIOChunker():
 
     def __next__(self):
         if self.process.poll():
-            raise EnvironmentError("Subprocess exited due to an error:\n" + ''.join(self.error))
+            raise EnvironmentError("Subprocess exited due to an error:\n" + b''.join(self.error).decode('utf8', 'replace'))
         # print('output', self.output)
-        return self.output.next()
+        try:
+            return self.output.next()
+        except StopIteration:
+            # stdout is at EOF. If the subprocess died half way through, say so
+            # instead of letting the output pass as complete.
+            try:
+                _returncode = self.process.wait(1)
+            except subprocess.TimeoutExpired:
+                _returncode = None
+            if _returncode:
+                raise EnvironmentError("Subprocess exited due to an error:\n" + b''.join(self.error).decode('utf8', 'replace'))
+            raise
 
     def throw(self, type, value=None, traceback=None):
         if self.output.length or not self.output.done_reading:
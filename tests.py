@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
-import unittest2 as unittest
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
 from os.path import join
 import subprocess
 import tempfile
 import socket
 import signal
 import shutil
+import io
 import time
 import os
 
@@ -91,3 +95,426 @@ class TestGit(unittest.TestCase):
         call('git', 'commit', '-m', 'test')
         call('git', 'push', 'origin', 'master')
 
+
+def init_bare(path):
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+
+def git(repo, *args, **kwargs):
+    env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@a',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@a')
+    return subprocess.check_output(('git', '--git-dir', repo) + args,
+                                   env=env, **kwargs).strip()
+
+def commit(repo, message):
+    tree = git(repo, 'mktree', stdin=subprocess.DEVNULL)
+    commit = git(repo, 'commit-tree', tree, '-m', message)
+    git(repo, 'update-ref', 'refs/heads/master', commit)
+    return commit
+
+def pkt(line):
+    return b'%04x' % (len(line) + 4) + line
+
+def post(app, path, stream, length=None, **headers):
+    """POST what stream holds, announcing only length bytes of it when length is set."""
+    from webob import Request
+    environ = {'REQUEST_METHOD': 'POST', 'wsgi.input': stream}
+    if length is not None:
+        environ['CONTENT_LENGTH'] = str(length)
+    resp = Request.blank(path, environ=environ, headers=headers).get_response(app)
+    resp.body
+    return resp
+
+def get(app, path, **headers):
+    from webob import Request
+    resp = Request.blank(path, headers=headers).get_response(app)
+    # read the body now, as a client would, rather than lazily
+    resp.body
+    return resp
+
+class TestGitDirectory(unittest.TestCase):
+
+    def setUp(self):
+        import gitweb
+        self.wd = tempfile.mkdtemp(prefix='gitweb-')
+        self.addCleanup(shutil.rmtree, self.wd)
+        self.repos = realpath(self.wd, 'repos')
+        init_bare(join(self.repos, 'sample.git'))
+        # a repository next to the served one, which must not be reachable
+        init_bare(join(self.wd, 'repos-evil', 'x.git'))
+        self.app = gitweb.GitDirectory(self.repos, auto_create=False)
+
+    def test_serves_repository(self):
+        resp = get(self.app, '/sample.git/info/refs?service=git-upload-pack')
+        self.assertEqual(resp.status_int, 200)
+
+    def test_rejects_unsafe_names(self):
+        for path in ['/.sample.git', '/..git', '/a%5cb.git', '/C:sample.git', '/D:evil.git', '/a:b.git',
+                     '/a%00b.git']:
+            resp = get(self.app, path + '/info/refs?service=git-upload-pack')
+            self.assertEqual(resp.status_int, 403, path)
+
+    def test_sibling_directory(self):
+        for path in ['/../repos-evil/x.git', '/..%2frepos-evil%2fx.git', '/repos-evil.git']:
+            resp = get(self.app, path + '/info/refs?service=git-upload-pack')
+            self.assertIn(resp.status_int, (403, 404), path)
+
+    def test_removed_repository(self):
+        path = '/sample.git/info/refs?service=git-upload-pack'
+        self.assertEqual(get(self.app, path).status_int, 200)
+        shutil.rmtree(join(self.repos, 'sample.git'))
+        self.assertEqual(get(self.app, path).status_int, 404)
+        self.assertEqual(self.app._apps, {})
+
+    def test_custom_repository_app(self):
+        class Custom(object):
+            # an override written before chunk_size existed
+            def __init__(self, content_path):
+                self.content_path = content_path
+
+            def __call__(self, environ, start_response):
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                return [self.content_path.encode('utf8')]
+
+        os.mkdir(join(self.repos, 'plain.git'))
+        self.app.repository_app = Custom
+        resp = get(self.app, '/plain.git/info/refs?service=git-upload-pack')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, join(self.repos, 'plain.git').encode('utf8'))
+
+    def test_update_server_info(self):
+        import gitweb
+        import warnings
+        from unittest import mock
+        app = gitweb.GitRepository(join(self.repos, 'sample.git'))
+        procs = []
+        Popen = subprocess.Popen
+
+        def popen(*args, **kwargs):
+            procs.append(Popen(*args, **kwargs))
+            return procs[-1]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            with mock.patch.object(gitweb.subprocess, 'Popen', popen):
+                app.update_server_info()
+            # the child gets reaped without anyone polling it
+            deadline = time.time() + 10
+            while procs[0].returncode is None and time.time() < deadline:
+                time.sleep(0.01)
+            del procs[:]
+        self.assertEqual(caught, [])
+        self.assertTrue(os.path.exists(join(self.repos, 'sample.git', 'info', 'refs')))
+
+    def fetch(self, announce, trailer=b''):
+        """Fetch the repository's commit, returns the bytes git was given and read."""
+        sha = commit(join(self.repos, 'sample.git'), 'first')
+        body = pkt(b'want ' + sha + b'\n') + b'0000' + pkt(b'done\n')
+        stream = io.BytesIO(body + trailer)
+        resp = post(self.app, '/sample.git/git-upload-pack', stream,
+                    len(body) if announce else None,
+                    Accept='application/x-git-upload-pack-result')
+        self.assertEqual(resp.status_int, 200)
+        self.assertTrue(resp.body.startswith(b'0008NAK\nPACK'))
+        return len(body), stream.tell()
+
+    def test_post_with_length(self):
+        # only CONTENT_LENGTH bytes are git's, a server may have more queued
+        given, read = self.fetch(True, trailer=b'next request')
+        self.assertEqual(read, given)
+
+    def test_post_without_length(self):
+        # chunked request body, read until EOF
+        given, read = self.fetch(False)
+        self.assertEqual(read, given)
+
+class TestCopyLimited(unittest.TestCase):
+
+    class Trickle(object):
+        """A file-like without readinto, handing out at most 3 bytes per read."""
+        def __init__(self, data):
+            self.stream = io.BytesIO(data)
+
+        def read(self, size):
+            return self.stream.read(min(size, 3))
+
+    def copy(self, src, n=None, buf=None):
+        from subprocessio import copy_limited
+        r, w = os.pipe()
+        try:
+            copy_limited(src, w, n, buf)
+        finally:
+            os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            return f.read()
+
+    def test_short_reads(self):
+        src = self.Trickle(b'0123456789' * 10 + b'next request')
+        self.assertEqual(self.copy(src, 100), b'0123456789' * 10)
+        self.assertEqual(src.stream.read(), b'next request')
+
+    def test_small_buffer(self):
+        src = io.BytesIO(b'0123456789' * 10 + b'next request')
+        self.assertEqual(self.copy(src, 100, bytearray(7)), b'0123456789' * 10)
+        self.assertEqual(src.read(), b'next request')
+
+    def test_until_eof(self):
+        src = self.Trickle(b'0123456789' * 10)
+        self.assertEqual(self.copy(src), b'0123456789' * 10)
+
+    def test_source_shorter_than_n(self):
+        self.assertEqual(self.copy(io.BytesIO(b'abc'), 100), b'abc')
+
+def age(path, seconds=60):
+    """Move the mtimes under path into the past, out of the racy window."""
+    then = time.time() - seconds
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            os.utime(join(dirpath, name), (then, then))
+        os.utime(dirpath, (then, then))
+
+class TestAdvert(unittest.TestCase):
+
+    path = '/info/refs?service=git-upload-pack'
+
+    def setUp(self):
+        import gitweb
+        from unittest import mock
+        self.wd = tempfile.mkdtemp(prefix='gitweb-')
+        self.addCleanup(shutil.rmtree, self.wd)
+        self.repo = realpath(self.wd, 'sample.git')
+        init_bare(self.repo)
+        self.commit('first')
+        age(self.repo)
+        gitweb.advert_cache.data.clear()
+        self.app = gitweb.GitRepository(self.repo)
+        patcher = mock.patch.object(gitweb.subprocessio, 'SubprocessIOChunker',
+                                    wraps=gitweb.subprocessio.SubprocessIOChunker)
+        self.chunker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def git(self, *args, **kwargs):
+        return git(self.repo, *args, **kwargs)
+
+    def commit(self, message):
+        return commit(self.repo, message)
+
+    def test_cache_hit(self):
+        first = get(self.app, self.path)
+        second = get(self.app, self.path)
+        self.assertEqual(first.status_int, 200)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(self.chunker.call_count, 1)
+
+    def test_not_modified(self):
+        etag = get(self.app, self.path).headers['ETag']
+        resp = get(self.app, self.path, **{'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(resp.body, b'')
+        self.assertEqual(self.chunker.call_count, 1)
+
+    def test_ref_update(self):
+        first = get(self.app, self.path)
+        commit = self.commit('second')
+        age(self.repo)
+        second = get(self.app, self.path)
+        self.assertIn(commit, second.body)
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(self.chunker.call_count, 2)
+
+    def test_config_change(self):
+        first = get(self.app, self.path)
+        self.git('config', 'uploadpack.hiderefs', 'refs/heads')
+        age(self.repo)
+        second = get(self.app, self.path)
+        self.assertIn(b' refs/heads/master\n', first.body)
+        self.assertNotIn(b' refs/heads/master\n', second.body)
+        self.assertEqual(self.chunker.call_count, 2)
+
+    def test_alternates_change(self):
+        etag = get(self.app, self.path).headers['ETag']
+        other = realpath(self.wd, 'other.git')
+        init_bare(other)
+        with open(join(self.repo, 'objects', 'info', 'alternates'), 'w') as f:
+            f.write(join(other, 'objects') + '\n')
+        age(self.repo)
+        resp = get(self.app, self.path, **{'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(self.chunker.call_count, 2)
+
+    def test_shallow_change(self):
+        first = get(self.app, self.path)
+        sha = self.git('rev-parse', 'refs/heads/master')
+        with open(join(self.repo, 'shallow'), 'wb') as f:
+            f.write(sha + b'\n')
+        age(self.repo)
+        second = get(self.app, self.path)
+        self.assertNotIn(b'shallow ' + sha, first.body)
+        self.assertIn(b'shallow ' + sha, second.body)
+        self.assertEqual(self.chunker.call_count, 2)
+
+    def test_receive_pack_not_cached(self):
+        # its advertisement may carry a fresh push-cert nonce every time
+        path = '/info/refs?service=git-receive-pack'
+        first = get(self.app, path)
+        get(self.app, path)
+        self.assertEqual(first.status_int, 200)
+        self.assertNotIn('ETag', first.headers)
+        self.assertEqual(self.chunker.call_count, 2)
+
+    def test_racy_refs(self):
+        self.commit('second')
+        first = get(self.app, self.path)
+        self.assertNotIn('ETag', first.headers)
+        get(self.app, self.path)
+        self.assertEqual(self.chunker.call_count, 2)
+
+def asgi(app, path, method='GET', body=b'', headers=(), sent=None):
+    """Run one request through an ASGI app, returns the messages it sent."""
+    import asyncio
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'root_path': '',
+             'query_string': query.encode('latin-1'),
+             'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = [] if sent is None else sent
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # nothing more to read, wait until the app is done
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        import gitweb_asgi
+        self.wd = tempfile.mkdtemp(prefix='gitweb-')
+        self.addCleanup(shutil.rmtree, self.wd)
+        self.repos = realpath(self.wd, 'repos')
+        self.repo = join(self.repos, 'sample.git')
+        init_bare(self.repo)
+        self.app = gitweb_asgi.AsyncGitDirectory(self.repos)
+
+    def status(self, sent):
+        starts = [m for m in sent if m['type'] == 'http.response.start']
+        self.assertEqual(len(starts), 1)
+        return starts[0]['status']
+
+    def body(self, sent):
+        return b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+
+    def test_inforefs(self):
+        sent = asgi(self.app, '/sample.git/info/refs?service=git-upload-pack')
+        self.assertEqual(self.status(sent), 200)
+        self.assertTrue(self.body(sent).startswith(b'001d# service=git-upload-pack'))
+
+    def test_bad_service(self):
+        sent = asgi(self.app, '/sample.git/info/refs?service=git-evil')
+        self.assertEqual(self.status(sent), 405)
+
+    def test_unknown_repository(self):
+        sent = asgi(self.app, '/missing.git/info/refs?service=git-upload-pack')
+        self.assertEqual(self.status(sent), 404)
+
+    def test_rejects_unsafe_names(self):
+        for path in ['/.sample.git', '/a\\b.git', '/C:sample.git', '/a:b.git', '/a\x00b.git']:
+            sent = asgi(self.app, path + '/info/refs?service=git-upload-pack')
+            self.assertEqual(self.status(sent), 403, path)
+
+    def test_custom_repository_app(self):
+        import gitweb_asgi
+
+        class Custom(gitweb_asgi.AsyncGitRepository):
+            # an override without chunk_size
+            def __init__(self, content_path):
+                super(Custom, self).__init__(content_path)
+
+        self.app.repository_app = Custom
+        sent = asgi(self.app, '/sample.git/info/refs?service=git-upload-pack')
+        self.assertEqual(self.status(sent), 200)
+
+    def test_removed_repository(self):
+        path = '/sample.git/info/refs?service=git-upload-pack'
+        self.assertEqual(self.status(asgi(self.app, path)), 200)
+        shutil.rmtree(self.repo)
+        self.assertEqual(self.status(asgi(self.app, path)), 404)
+        self.assertEqual(self.app._apps, {})
+
+    def test_receive_pack_updates_server_info(self):
+        # an empty push, receive-pack still succeeds
+        sent = asgi(self.app, '/sample.git/git-receive-pack', 'POST', b'0000',
+                    [('accept', 'application/x-git-receive-pack-result')])
+        self.assertEqual(self.status(sent), 200)
+        # done, and waited for, by the time the request is
+        self.assertTrue(os.path.exists(join(self.repo, 'info', 'refs')))
+
+    def test_upload_pack(self):
+        # an empty negotiation, git answers with nothing and exits cleanly
+        sent = asgi(self.app, '/sample.git/git-upload-pack', 'POST', b'0000',
+                    [('accept', 'application/x-git-upload-pack-result')])
+        self.assertEqual(self.status(sent), 200)
+        self.assertEqual(self.body(sent), b'')
+
+    def test_git_failure(self):
+        # not a pkt-line, git dies without output
+        with self.assertLogs('gitweb_asgi', 'ERROR'):
+            sent = asgi(self.app, '/sample.git/git-upload-pack', 'POST', b'garbage',
+                        [('accept', 'application/x-git-upload-pack-result')])
+        self.assertEqual(self.status(sent), 417)
+
+    def broken(self, started):
+        import gitweb_asgi
+        procs = []
+
+        class Broken(gitweb_asgi.AsyncGitRepository):
+            async def start(self, cmd, stdin=None):
+                # a git that never finishes on its own
+                procs.append(await super(Broken, self).start(['sleep', '60'], stdin))
+                return procs[-1]
+
+            async def stream(self, proc, send, content_type, starting_values=()):
+                if started:
+                    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+                raise RuntimeError('lost git')
+
+        self.app.repository_app = Broken
+        return procs
+
+    def test_error_after_start(self):
+        procs = self.broken(started=True)
+        sent = []
+        with self.assertRaises(RuntimeError):
+            asgi(self.app, '/sample.git/info/refs?service=git-upload-pack', sent=sent)
+        # no error page once the response started
+        self.assertEqual(sent, [{'type': 'http.response.start', 'status': 200, 'headers': []}])
+        self.assertEqual(procs[0].returncode, -signal.SIGKILL)
+
+    def test_error_before_start(self):
+        procs = self.broken(started=False)
+        with self.assertLogs('gitweb_asgi', 'ERROR'):
+            sent = asgi(self.app, '/sample.git/info/refs?service=git-upload-pack')
+        self.assertEqual(self.status(sent), 500)
+        self.assertEqual(procs[0].returncode, -signal.SIGKILL)
+
+    def test_git_dies_mid_stream(self):
+        import gitweb_asgi
+
+        class Dying(gitweb_asgi.AsyncGitRepository):
+            async def start(self, cmd, stdin=None):
+                return await super(Dying, self).start(['sh', '-c', 'echo partial; exit 3'], stdin)
+
+        self.app.repository_app = Dying
+        sent = []
+        with self.assertLogs('gitweb_asgi', 'ERROR'):
+            with self.assertRaises(EnvironmentError):
+                asgi(self.app, '/sample.git/info/refs?service=git-upload-pack', sent=sent)
+        self.assertEqual(self.status(sent), 200)
+        # the body is never terminated, the server has to drop the connection
+        self.assertTrue(sent[-1]['more_body'])